@@ -1,9 +1,15 @@
 # database.py
-# Database engine and session
+# Async database engine and session
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from app.config import DATABASE_URL
 
-engine = create_engine(DATABASE_URL, echo=False)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# asyncpg keeps queries from blocking the event loop; the async engine
+# wraps its connections in AsyncAdaptedQueuePool by default.
+engine = create_async_engine(
+    DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://"),
+    echo=False,
+    pool_size=20,
+    max_overflow=10,
+)
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
@@ -2,15 +2,28 @@
 # FastAPI app entry point
 
 from fastapi import FastAPI
-from app.routes import router as api_router
+from app.config import SERVE_STATIC_IMAGES
+from app.routes import router as api_router, init_http_session, close_http_session
 from fastapi.staticfiles import StaticFiles
 
 app = FastAPI(title="Image Processor API")
 
 app.include_router(api_router)
 
-# Mount the processed_images directory to serve processed images
-app.mount("/processed_images", StaticFiles(directory="processed_images"), name="processed_images")
+@app.on_event("startup")
+async def startup_event():
+    await init_http_session()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_http_session()
+
+# Mount the processed_images directory to serve processed images.
+# In production this mount is disabled and nginx serves the files with
+# sendfile, which streams from page cache to socket without passing
+# every byte through Python (see README).
+if SERVE_STATIC_IMAGES:
+    app.mount("/processed_images", StaticFiles(directory="processed_images"), name="processed_images")
 
 @app.get("/")
 async def root():
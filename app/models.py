@@ -1,8 +1,9 @@
 # models.py
 # SQLAlchemy models
 
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
 Base = declarative_base()
@@ -10,15 +11,24 @@ Base = declarative_base()
 class ProcessingRequest(Base):
     __tablename__ = "processing_requests"
 
-    id = Column(Integer, primary_key=True, index=True)
-    request_id = Column(String, unique=True, index=True)
+    # request_id is the natural key and every lookup filters on it, so
+    # it is the primary key outright -- no surrogate integer id and no
+    # second unique index to maintain.
+    request_id = Column(String, primary_key=True)
     status = Column(String, default="pending")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     completed_at = Column(DateTime(timezone=True), nullable=True)
     callback_url = Column(String, nullable=True)
 
+    products = relationship("Product", back_populates="processing_request")
+
 class Product(Base):
     __tablename__ = "products"
+    # Composite index serves both the plain request_id lookups and the
+    # request_id + status filters.
+    __table_args__ = (
+        Index("ix_products_request_id_status", "request_id", "status"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     request_id = Column(String, ForeignKey("processing_requests.request_id"))
@@ -26,4 +36,6 @@ class Product(Base):
     product_name = Column(String)
     input_image_urls = Column(Text)
     output_image_urls = Column(Text, nullable=True)
-    status = Column(String, default="pending")
\ No newline at end of file
+    status = Column(String, default="pending")
+
+    processing_request = relationship("ProcessingRequest", back_populates="products")
\ No newline at end of file
@@ -4,20 +4,42 @@
 import os
 import io
 import csv
+import gc
+import logging
 import re
 import uuid
-import time
-import requests
+import asyncio
+import aiohttp
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
-from datetime import datetime
+from functools import lru_cache
 from PIL import Image
+
+# libvips streams images tile-by-tile instead of decoding the full
+# image into memory; fall back to Pillow where it isn't installed.
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+# mozjpeg re-packs the entropy coding of an already-encoded JPEG for a
+# further size reduction at identical pixels; optional at runtime.
+try:
+    import mozjpeg_lossless_optimization
+except ImportError:
+    mozjpeg_lossless_optimization = None
 from fastapi import APIRouter, HTTPException, Depends, File, UploadFile, BackgroundTasks
 from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
+from app.config import MAX_IMAGE_DIM
 from app.database import SessionLocal
 from app.models import ProcessingRequest, Product
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
 # Directory to store output CSV files
@@ -30,24 +52,76 @@ PROCESSED_DIR = "processed_images"
 if not os.path.exists(PROCESSED_DIR):
     os.makedirs(PROCESSED_DIR)
 
-def get_db():
+# Shared aiohttp session so image downloads reuse pooled connections
+# instead of opening a new socket per URL. Created on app startup.
+http_session = None
+
+async def init_http_session():
+    """Create the shared aiohttp session. Called on app startup."""
+    global http_session
+    http_session = aiohttp.ClientSession(
+        # ttl_dns_cache avoids re-resolving the same image hosts on
+        # every download for 5 minutes.
+        connector=aiohttp.TCPConnector(limit=128, limit_per_host=8, ttl_dns_cache=300),
+        headers={"Accept-Encoding": "gzip, deflate"}
+    )
+
+# Global cap on in-flight images, held from download through encode and
+# shared by every background task. Two huge uploads landing together
+# stay bounded instead of holding every image body in memory at once;
+# the connector's limit_per_host additionally keeps any single remote
+# host from being hammered.
+download_semaphore = asyncio.Semaphore(64)
+
+# JPEG encodes run in worker processes so a batch uses every core
+# instead of contending for the GIL around the Python-level glue.
+encode_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+# Upstream JPEGs at or below this size are passed through untouched;
+# a decode + re-encode would cost full IDCT/FDCT for what is
+# effectively a copy.
+SMALL_JPEG_MAX_BYTES = 200 * 1024
+
+async def close_http_session():
+    """Close the shared aiohttp session. Called on app shutdown."""
+    if http_session is not None:
+        await http_session.close()
+
+async def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
+
+# Compiled once at import; normalize() runs on every header column of
+# every upload, so don't pay the regex-cache lookup per call.
+_NORMALIZE_RE = re.compile(r'\W+')
 
 def normalize(text: str) -> str:
     """Remove non-alphanumeric characters and convert to lowercase."""
-    return re.sub(r'\W+', '', text).lower()
+    return _NORMALIZE_RE.sub('', text).lower()
+
+@lru_cache(maxsize=1024)
+def output_csv_path(request_id: str) -> str:
+    """Cached request_id -> output CSV path mapping."""
+    return os.path.join(OUTPUT_DIR, f"{request_id}_output.csv")
 
-def generate_output_csv(request_id: str, db: Session):
+async def generate_output_csv(request_id: str, db: AsyncSession):
     """
     Generate an output CSV file for a given request.
     Columns: S. No, Product Name, Input Image Urls, Output Image Urls.
     """
-    products = db.query(Product).filter(Product.request_id == request_id).all()
-    output_file = os.path.join(OUTPUT_DIR, f"{request_id}_output.csv")
+    # populate_existing refreshes any Product instances already in the
+    # session's identity map; the bulk UPDATE in process_images doesn't
+    # sync them, and this runs in that same session before commit.
+    result = await db.execute(
+        select(Product)
+        .where(Product.request_id == request_id)
+        .execution_options(populate_existing=True)
+    )
+    products = result.scalars().all()
+    output_file = output_csv_path(request_id)
     with open(output_file, "w", newline='', encoding="utf-8") as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(["S. No", "Product Name", "Input Image Urls", "Output Image Urls"])
@@ -60,79 +134,221 @@ def generate_output_csv(request_id: str, db: Session):
             ])
     return output_file
 
-def process_images(request_id: str):
+async def download_image(url: str) -> tuple:
+    """Download a single image, streaming it into a buffer the decoder
+    can read directly -- no intermediate bytes object is built.
+    Returns (buffer, content type)."""
+    buf = BytesIO()
+    async with http_session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+        response.raise_for_status()
+        content_type = response.content_type
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            buf.write(chunk)
+    buf.seek(0)
+    return buf, content_type
+
+def optimize_jpeg(data: bytes) -> bytes:
+    """Losslessly shrink encoded JPEG bytes with mozjpeg when available."""
+    if mozjpeg_lossless_optimization is not None:
+        try:
+            return mozjpeg_lossless_optimization.optimize(data)
+        except Exception as e:
+            logger.warning("mozjpeg optimization failed, keeping original encoding: %s", e)
+    return data
+
+def compress_image(buf: BytesIO) -> tuple:
+    """Compress a buffered image to a 50% quality JPEG in memory.
+    Returns (filename, encoded bytes); the caller batches the disk writes."""
+    # Create a unique filename
+    new_filename = f"{uuid.uuid4()}.jpg"
+    if pyvips is not None:
+        try:
+            if MAX_IMAGE_DIM:
+                # thumbnail_buffer shrinks on load (using libjpeg's
+                # shrink-on-load for JPEG sources), so the cap is
+                # honored here just like on the Pillow path below.
+                # size="down" never enlarges smaller images.
+                vips_img = pyvips.Image.thumbnail_buffer(
+                    buf.getbuffer(), MAX_IMAGE_DIM,
+                    height=MAX_IMAGE_DIM, size="down")
+            else:
+                # access="sequential" keeps peak memory at one tile strip
+                # rather than the whole decoded image. getbuffer() hands
+                # vips a view of the download buffer without copying it.
+                vips_img = pyvips.Image.new_from_buffer(buf.getbuffer(), "", access="sequential")
+            try:
+                data = vips_img.jpegsave_buffer(Q=50, strip=True, optimize_coding=True)
+            finally:
+                # Drop the image (and its view of the download buffer)
+                # even when the save fails -- otherwise the exported
+                # memoryview makes buf.close() in the fallback raise
+                # BufferError -- and so the source bytes can be
+                # reclaimed before this worker picks up the next image.
+                del vips_img
+            buf.close()
+            return new_filename, optimize_jpeg(data)
+        except pyvips.Error as e:
+            # Fall back to Pillow for formats vips can't read
+            logger.warning("pyvips could not process image, falling back to Pillow: %s", e)
+    buf.seek(0)
+    img = Image.open(buf)
+    if MAX_IMAGE_DIM and img.format == "JPEG":
+        # draft() tells libjpeg to decode at the nearest 1/2, 1/4 or 1/8
+        # scale, reading only the DCT coefficients needed for that size
+        # -- far cheaper than a full decode for large sources.
+        img.draft("RGB", (MAX_IMAGE_DIM, MAX_IMAGE_DIM))
+    # Compress to 50% quality; skipping the optimize/progressive passes
+    # avoids a second Huffman pass over the encoded data.
+    out = BytesIO()
+    img.convert("RGB").save(out, format="JPEG", quality=50,
+                            optimize=False, progressive=False)
+    # Release the decoded bitmap and the download buffer promptly; both
+    # can be far larger than the encoded output.
+    img.close()
+    buf.close()
+    return new_filename, optimize_jpeg(out.getvalue())
+
+def write_image_batch(batch):
+    """Write all encoded images for a request in one sequential pass,
+    with a single open/write/close syscall sequence per file."""
+    for path, data in batch:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+async def process_images(request_id: str):
     """
-    1. Download each image URL and compress it to 50% quality.
-    2. Save the compressed file locally under processed_images.
-    3. Update the product record with the new local URL.
+    1. Download all image URLs concurrently and compress each to 50% quality.
+    2. Save the compressed files locally under processed_images.
+    3. Update the product records with the new local URLs.
     4. Mark the request as completed and set completed_at.
     5. If callback_url is provided, POST to that URL with status info.
     """
     db = SessionLocal()
     try:
-        products = db.query(Product).filter(Product.request_id == request_id).all()
+        result = await db.execute(select(Product).where(Product.request_id == request_id))
+        products = result.scalars().all()
+
+        # Collect every (product, url) pair so downloads for the whole
+        # request can be awaited at once.
+        jobs = []
         for product in products:
-            new_urls = []
-            input_urls = product.input_image_urls.split(',')
-            for url in input_urls:
+            for index, url in enumerate(product.input_image_urls.split(',')):
                 url = url.strip()
-                if not url:
-                    continue
-                try:
-                    response = requests.get(url, stream=True, timeout=10)
-                    if response.status_code == 200:
-                        img = Image.open(BytesIO(response.content))
-                        # Create a unique filename
-                        new_filename = f"{uuid.uuid4()}.jpg"
-                        new_path = os.path.join(PROCESSED_DIR, new_filename)
-                        # Compress to 50% quality
-                        img.convert("RGB").save(new_path, format="JPEG", quality=50)
-                        # Construct local URL
-                        local_url = f"/processed_images/{new_filename}"
-                        new_urls.append(local_url)
-                    else:
-                        print(f"Failed to download image from {url}, status code: {response.status_code}")
-                except Exception as e:
-                    print(f"Error downloading or processing image {url}: {e}")
-            
-            product.output_image_urls = ','.join(new_urls)
-            product.status = "processed"
-            db.add(product)
-            # Optional short delay
-            time.sleep(0.5)
-        
-        # Update the request status and completed_at
-        processing_request = db.query(ProcessingRequest).filter(ProcessingRequest.request_id == request_id).first()
-        if processing_request:
-            processing_request.status = "completed"
-            processing_request.completed_at = datetime.utcnow()
-            db.add(processing_request)
-        db.commit()
+                if url:
+                    jobs.append((product.id, index, url))
+
+        loop = asyncio.get_running_loop()
+
+        async def fetch_and_compress(url):
+            # Hold the semaphore through the encode, not just the
+            # download: downloads finish much faster than the encode
+            # pool drains them, and releasing early would let every
+            # image body of a large upload pile up in the pool's queue.
+            async with download_semaphore:
+                buf, content_type = await download_image(url)
+                # Small upstream JPEGs are already in the target format
+                # at a reasonable size: stream the bytes through as-is
+                # and skip the decode + re-encode entirely.
+                if content_type == "image/jpeg" and buf.getbuffer().nbytes <= SMALL_JPEG_MAX_BYTES:
+                    return f"{uuid.uuid4()}.jpg", buf.getvalue()
+                # Run the CPU-bound JPEG encode in the process pool so
+                # encodes scale across cores and never touch the event loop.
+                return await loop.run_in_executor(encode_pool, compress_image, buf)
+
+        outcomes = await asyncio.gather(
+            *(fetch_and_compress(url) for _, _, url in jobs),
+            return_exceptions=True
+        )
+
+        # product.id -> {url index -> local url}, so per-product output
+        # order matches the input order regardless of completion order.
+        results = {}
+        write_batch = []
+        for (product_id, index, url), outcome in zip(jobs, outcomes):
+            if isinstance(outcome, Exception):
+                logger.warning("Error downloading or processing image %s: %s", url, outcome)
+            else:
+                new_filename, data = outcome
+                write_batch.append((os.path.join(PROCESSED_DIR, new_filename), data))
+                results.setdefault(product_id, {})[index] = f"/processed_images/{new_filename}"
+        # outcomes holds a second reference to every encoded image; drop
+        # it so write_batch is the only owner.
+        del outcomes
+
+        # Flush all image files in one batch off the event loop, keeping
+        # write latency out of the per-image path.
+        if write_batch:
+            await loop.run_in_executor(None, write_image_batch, write_batch)
+        write_batch.clear()
+        # One collection per request batch reclaims any remaining cyclic
+        # garbage from the download/encode pipeline.
+        gc.collect()
+
+        # Batch all product updates into one multi-row statement instead
+        # of flushing a separate UPDATE per product.
+        updates = []
+        for product in products:
+            urls_by_index = results.get(product.id, {})
+            new_urls = [urls_by_index[i] for i in sorted(urls_by_index)]
+            updates.append({
+                "id": product.id,
+                "output_image_urls": ','.join(new_urls),
+                "status": "processed"
+            })
+        if updates:
+            # ORM bulk UPDATE by primary key: one executemany statement
+            await db.execute(update(Product), updates)
+
+        # Update the request status; completed_at is stamped server-side
+        # so no Python datetime is built and serialized per request.
+        await db.execute(
+            update(ProcessingRequest)
+            .where(ProcessingRequest.request_id == request_id)
+            .values(status="completed", completed_at=func.now())
+        )
+        result = await db.execute(
+            select(ProcessingRequest.callback_url).where(ProcessingRequest.request_id == request_id)
+        )
+        callback_url = result.scalar_one_or_none()
+
+        # Write the output CSV before committing the completed status,
+        # so /status never advertises a download link for a file that
+        # doesn't exist yet (and a crash here rolls the status back
+        # rather than stranding a completed request with no CSV).
+        await generate_output_csv(request_id, db)
+        await db.commit()
 
         # Trigger the webhook if callback_url is provided
-        if processing_request and processing_request.callback_url:
+        if callback_url:
             try:
                 payload = {
                     "request_id": request_id,
                     "status": "completed"
                 }
-                resp = requests.post(processing_request.callback_url, json=payload, timeout=5)
-                if resp.status_code < 200 or resp.status_code >= 300:
-                    print(f"Webhook call failed, status: {resp.status_code}")
+                async with http_session.post(
+                    callback_url,
+                    json=payload,
+                    timeout=aiohttp.ClientTimeout(total=5)
+                ) as resp:
+                    if resp.status < 200 or resp.status >= 300:
+                        logger.warning("Webhook call failed, status: %s", resp.status)
             except Exception as e:
-                print(f"Error calling webhook for request {request_id}: {e}")
+                logger.error("Error calling webhook for request %s: %s", request_id, e)
 
     except Exception as e:
-        db.rollback()
-        print(f"Error processing images for request {request_id}: {e}")
+        await db.rollback()
+        logger.exception("Error processing images for request %s: %s", request_id, e)
     finally:
-        db.close()
+        await db.close()
 
 @router.post("/upload")
 async def upload_csv(
     file: UploadFile = File(...),
     webhook_url: str = None,  # optional
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     background_tasks: BackgroundTasks = BackgroundTasks()
 ):
     # Validate file type
@@ -163,23 +379,30 @@ async def upload_csv(
     )
     db.add(new_request)
     
+    # Accumulate plain mappings and insert them in one multi-row
+    # statement instead of one INSERT per row at flush time.
+    products = []
     for row in csv_reader:
         if len(row) != 3:
             raise HTTPException(status_code=400, detail="CSV row does not have exactly 3 columns.")
         serial_number, product_name, input_image_urls = row
-        product = Product(
-            request_id=request_id,
-            serial_number=serial_number.strip(),
-            product_name=product_name.strip(),
-            input_image_urls=input_image_urls.strip(),
-            status="pending"
-        )
-        db.add(product)
-    
+        products.append({
+            "request_id": request_id,
+            "serial_number": serial_number.strip(),
+            "product_name": product_name.strip(),
+            "input_image_urls": input_image_urls.strip(),
+            "status": "pending"
+        })
+
     try:
-        db.commit()
+        # The session has autoflush off, so flush the parent request row
+        # explicitly before the products INSERT hits its FK.
+        await db.flush()
+        if products:
+            await db.execute(insert(Product), products)
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Error saving request and product data.")
     
     # Schedule background processing
@@ -188,12 +411,19 @@ async def upload_csv(
     return {"request_id": request_id, "message": "CSV file uploaded and processing started."}
 
 @router.get("/status/{request_id}")
-async def get_status(request_id: str, db: Session = Depends(get_db)):
-    processing_request = db.query(ProcessingRequest).filter(ProcessingRequest.request_id == request_id).first()
+async def get_status(request_id: str, db: AsyncSession = Depends(get_db)):
+    # Load the request and its products in one round trip instead of
+    # two sequential queries.
+    result = await db.execute(
+        select(ProcessingRequest)
+        .where(ProcessingRequest.request_id == request_id)
+        .options(selectinload(ProcessingRequest.products))
+    )
+    processing_request = result.scalar_one_or_none()
     if not processing_request:
         raise HTTPException(status_code=404, detail="Request not found")
-    
-    products = db.query(Product).filter(Product.request_id == request_id).all()
+
+    products = processing_request.products
     products_data = [
         {
             "serial_number": product.serial_number,
@@ -215,16 +445,14 @@ async def get_status(request_id: str, db: Session = Depends(get_db)):
     }
     
     if processing_request.status == "completed":
-        output_file = os.path.join(OUTPUT_DIR, f"{request_id}_output.csv")
-        if not os.path.exists(output_file):
-            generate_output_csv(request_id, db)
+        # The CSV was written when processing completed; just link it.
         response["output_csv_link"] = f"/download/{request_id}"
     
     return response
 
 @router.get("/download/{request_id}")
 async def download_output_csv(request_id: str):
-    output_file = os.path.join(OUTPUT_DIR, f"{request_id}_output.csv")
+    output_file = output_csv_path(request_id)
     if not os.path.exists(output_file):
         raise HTTPException(status_code=404, detail="Output CSV not found.")
     return FileResponse(output_file, media_type="text/csv", filename=f"{request_id}_output.csv")
\ No newline at end of file
@@ -1,12 +1,15 @@
 # create_tables.py
 # Script to create database tables
 
+import asyncio
+
 from app.database import engine
 from app.models import Base
 
-def create_tables():
-    Base.metadata.create_all(bind=engine)
+async def create_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
     print("Tables created successfully.")
 
 if __name__ == "__main__":
-    create_tables()
+    asyncio.run(create_tables())